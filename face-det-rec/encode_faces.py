@@ -2,7 +2,7 @@
 Find faces in given images and encode into 128-D embeddings. 
 
 Usage:
-$ python3 encode_faces.py --dataset dataset --encodings encodings.pickle
+$ python3 encode_faces.py --dataset dataset --encodings encodings.pickle --gallery gallery.npz
 
 Part of the smart-zoneminder project:
 See https://github.com/goruck/smart-zoneminder.
@@ -14,6 +14,7 @@ import face_recognition
 import argparse
 import pickle
 import cv2
+import numpy as np
 from os.path import sep
 from glob import glob
 
@@ -35,6 +36,8 @@ ap.add_argument('-i', '--dataset', required=True,
     help='path to input directory of faces + images')
 ap.add_argument('-e', '--encodings', required=True,
     help='name of serialized output file of facial encodings')
+ap.add_argument('-g', '--gallery', type=str, default='gallery.npz',
+    help='name of output file of facial encodings as a float32 matrix')
 ap.add_argument('-d', '--detection-method', type=str, default='cnn',
     help='face detection model to use: either `hog` or `cnn`')
 args = vars(ap.parse_args())
@@ -147,4 +150,15 @@ print('\n faces encoded {} not encoded {} total {}'
 print('\n serializing encodings')
 data = {'encodings': knownEncodings, 'names': knownNames}
 with open(args['encodings'], 'wb') as outfile:
-    outfile.write(pickle.dumps(data))
\ No newline at end of file
+    outfile.write(pickle.dumps(data))
+
+# Save the facial encodings as a contiguous (N, 128) float32 matrix
+# along with an integer id per encoding and the id to name map.
+# This lets knn face compares use the gallery directly without restacking.
+print('\n saving gallery')
+id_to_name, name_ids = np.unique(knownNames, return_inverse=True)
+enc_mat = np.empty((len(knownEncodings), 128), dtype=np.float32)
+if knownEncodings:
+    enc_mat[:] = knownEncodings
+np.savez(args['gallery'], enc=enc_mat, ids=name_ids.astype(np.int32),
+    names=id_to_name)
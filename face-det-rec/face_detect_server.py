@@ -15,15 +15,22 @@ Copyright (c) 2018, 2019 Lindo St. Angel
 
 import numpy as np
 import cv2
+import dlib
 import face_recognition
+from face_recognition.api import pose_predictor_5_point, face_encoder
 import json
 import zerorpc
 import logging
 import pickle
 import gevent
 import signal
+from concurrent.futures import ThreadPoolExecutor
 
-logging.basicConfig(level=logging.ERROR)
+logging.basicConfig(
+    format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+    level=logging.ERROR)
+
+logger = logging.getLogger(__name__)
 
 # Get configuration.
 with open('./config.json') as fp:
@@ -59,9 +66,25 @@ NUMBER_OF_TIMES_TO_UPSAMPLE = config['numFaceImgUpsample']
 # Face detection model to use. Can be either 'cnn' or 'hog'.
 FACE_DET_MODEL = config['faceDetModel']
 
+# Person rois with an area (in pixels) less than this use the faster 'hog'
+# face detector even if the 'cnn' model is selected. Set to 0 to disable.
+HOG_MAX_AREA = config['hogMaxArea']
+
+# Largest padded size (batch size x height x width, in pixels before
+# upsampling) of a batch of person rois sent to the cnn face detector.
+# Bigger batches use the GPU better but need more memory.
+CNN_BATCH_PIXELS = config['cnnBatchPixels']
+
 # How many times to re-sample when calculating face encoding.
+# The encoder runs once per jitter so compute scales linearly with this.
+# Jitter mostly helps when encoding the known faces offline (encode_faces.py);
+# for alarm faces a single pass costs little accuracy.
+# See https://github.com/ageitgey/face_recognition/wiki/Face-Recognition-Accuracy-Problems.
 NUM_JITTERS = config['numJitters']
 
+# Number of threads used to read and decode alarm images.
+READER_THREADS = config['readerThreads']
+
 # Load face recognition model along with the label encoder.
 with open(MODEL_PATH, 'rb') as fp:
 	recognizer = pickle.load(fp)
@@ -74,19 +97,116 @@ def face_classifier(encoding, min_proba):
 	preds = recognizer.predict_proba(encoding.reshape(1, -1))[0]
 	j = np.argmax(preds)
 	proba = preds[j]
-	logging.debug('face classifier proba {} name {}'.format(proba, le.classes_[j]))
+	logger.debug('face classifier proba %s name %s', proba, le.classes_[j])
 	if proba >= min_proba:
 		name = le.classes_[j]
-		logging.debug('face classifier says this is {}'.format(name))
+		logger.debug('face classifier says this is %s', name)
 	else:
 		name = None # prob too low to recog face
-		logging.debug('face classifier cannot recognize face')
+		logger.debug('face classifier cannot recognize face')
 	return name, proba
 
+def cnn_batches(images):
+	# Split a list of images into batches for the cnn detector.
+	# dlib needs equal sized images in a batch so each batch is padded to
+	# its largest height and width. Images are sorted by orientation and
+	# size so similar shapes share a batch, and a batch is closed once its
+	# padded size would exceed CNN_BATCH_PIXELS. An image over the budget
+	# on its own gets a batch to itself, as in per-image detection.
+	order = sorted(range(len(images)), key=lambda i: (
+		images[i].shape[0] > images[i].shape[1], images[i].shape[:2]))
+	batches = []
+	batch = []
+	(max_h, max_w) = (0, 0)
+	for i in order:
+		(h, w) = images[i].shape[:2]
+		(new_h, new_w) = (max(max_h, h), max(max_w, w))
+		if batch and (len(batch) + 1) * new_h * new_w > CNN_BATCH_PIXELS:
+			batches.append(batch)
+			batch = []
+			(new_h, new_w) = (h, w)
+		batch.append(i)
+		(max_h, max_w) = (new_h, new_w)
+	if batch:
+		batches.append(batch)
+	return batches
+
+def cnn_face_locations(images):
+	# Find face locations in a list of rgb images with the cnn detector.
+	# Each batch runs through dlib in a single call, which needs equal
+	# sized images, so each is zero padded on the bottom and right to the
+	# largest height and width in its batch. Padding doesn't move face
+	# coordinates, they are just trimmed back to each image.
+	locations = [None] * len(images)
+	for idxs in cnn_batches(images):
+		max_h = max(images[i].shape[0] for i in idxs)
+		max_w = max(images[i].shape[1] for i in idxs)
+		batch = []
+		for i in idxs:
+			(h, w) = images[i].shape[:2]
+			padded = np.zeros((max_h, max_w, 3), dtype=np.uint8)
+			padded[:h, :w] = images[i]
+			batch.append(padded)
+		logger.debug('cnn face detection batch %s padded to %sx%s',
+			len(batch), max_h, max_w)
+		detections = face_recognition.batch_face_locations(batch,
+			NUMBER_OF_TIMES_TO_UPSAMPLE, batch_size=len(batch))
+		for (i, faces) in zip(idxs, detections):
+			(h, w) = images[i].shape[:2]
+			locations[i] = [(top, min(right, w), min(bottom, h), left)
+				for (top, right, bottom, left) in faces if top < h and left < w]
+	return locations
+
+def face_locations(images):
+	# Find face locations in a list of rgb images.
+	# With the cnn model, images smaller than HOG_MAX_AREA take the
+	# faster hog detector and only the larger ones go to the cnn.
+	# Both dlib detectors are loaded once by face_recognition.
+	if FACE_DET_MODEL != 'cnn':
+		return [face_recognition.face_locations(image, NUMBER_OF_TIMES_TO_UPSAMPLE,
+			FACE_DET_MODEL) for image in images]
+	locations = [None] * len(images)
+	cnn_idxs = []
+	for (i, image) in enumerate(images):
+		(h, w) = image.shape[:2]
+		if h * w < HOG_MAX_AREA:
+			locations[i] = face_recognition.face_locations(image,
+				NUMBER_OF_TIMES_TO_UPSAMPLE, 'hog')
+		else:
+			cnn_idxs.append(i)
+	logger.debug('face detection hog %s cnn %s',
+		len(images) - len(cnn_idxs), len(cnn_idxs))
+	cnn_locations = cnn_face_locations([images[i] for i in cnn_idxs])
+	for (i, faces) in zip(cnn_idxs, cnn_locations):
+		locations[i] = faces
+	return locations
+
+def face_encodings(faces):
+	# Compute the 128-d encodings of a list of (rgb image, css face location).
+	# Each face is aligned to a chip once and, if jitter is used, jittered
+	# NUM_JITTERS times on the cpu. Then the chips of all the faces go through
+	# the encoder in a single batched call and each face's encoding is the
+	# mean over its jitters, as dlib does for a single face.
+	if not faces:
+		return []
+	chips = []
+	for (image, (top, right, bottom, left)) in faces:
+		shape = pose_predictor_5_point(image, dlib.rectangle(left, top, right, bottom))
+		chip = dlib.get_face_chip(image, shape, size=150, padding=0.25)
+		if NUM_JITTERS > 1:
+			chips.extend(dlib.jitter_image(chip, num_jitters=NUM_JITTERS))
+		else:
+			chips.append(chip)
+	descriptors = np.array(face_encoder.compute_face_descriptor(chips))
+	return descriptors.reshape(len(faces), -1, 128).mean(axis=1)
+
 def variance_of_laplacian(image):
 	# compute the Laplacian of the image and then return the focus
 	# measure, which is simply the variance of the Laplacian
-	return cv2.Laplacian(image, cv2.CV_64F).var()
+	# the 8-bit image's Laplacian fits exactly in 16-bit ints so there
+	# is no need for a 64-bit float image to get the same variance
+	(_, stddev) = cv2.meanStdDev(cv2.Laplacian(image, cv2.CV_16S))
+	return stddev[0, 0] ** 2
 
 def image_resize(image, width=None, height=None, inter=cv2.INTER_AREA):
     # ref: https://stackoverflow.com/questions/44650888/resize-an-image-without-distortion-opencv
@@ -123,103 +243,162 @@ def image_resize(image, width=None, height=None, inter=cv2.INTER_AREA):
 
 # Define zerorpc class.
 class DetectRPC(object):
+    def __init__(self):
+        logger.debug('Starting server for face detection and recognition.')
+        # Thread pool that reads alarm images.
+        self.executor = ThreadPoolExecutor(max_workers=READER_THREADS)
+        # Run the detector, encoder and classifier once on a dummy image so
+        # that model and CUDA initialization happen at server start instead
+        # of on the first alarm image.
+        dummy = np.zeros((64, 64, 3), dtype=np.uint8)
+        face_locations([dummy])
+        if FACE_DET_MODEL == 'cnn':
+            cnn_face_locations([dummy])
+        encoding = face_encodings([(dummy, (0, 63, 63, 0))])[0]
+        recognizer.predict_proba(encoding.reshape(1, -1))
+
+    def close_server(self):
+        logger.debug('Closing server for face detection and recognition.')
+        self.executor.shutdown()
+
     def detect_faces(self, test_image_paths):
         # List that will hold all images with any face detection information. 
         objects_detected_faces = []
+        # Person labels to search for faces along with their image rois.
+        persons = []
+
+        # Start reading images with persons on the thread pool so decoding
+        # overlaps with processing the images already read.
+        # OpenCV releases the GIL while decoding.
+        image_reads = {obj['image']: self.executor.submit(cv2.imread, obj['image'])
+            for obj in test_image_paths
+            if any(label['name'] == 'person' for label in obj['labels'])}
 
-        # Loop over the images paths provided. 
+        # Loop over the images paths provided and gather the person rois. 
         for obj in test_image_paths:
-            logging.debug('**********Find Face(s) for {}'.format(obj['image']))
-            for label in obj['labels']:
-                # If the object detected is a person then try to identify face. 
-                if label['name'] == 'person':
-                    # Read image from disk. 
-                    img = cv2.imread(obj['image'])
-                    if img is None:
-                        # Bad image was read.
-                        logging.error('Bad image was read.')
-                        label['face'] = None
-                        continue
-
-                    # First bound the roi using the coord info passed in.
-                    # The roi is area around person(s) detected in image.
-                    # (x1, y1) are the top left roi coordinates.
-                    # (x2, y2) are the bottom right roi coordinates.
-                    y2 = int(label['box']['ymin'])
-                    x1 = int(label['box']['xmin'])
-                    y1 = int(label['box']['ymax'])
-                    x2 = int(label['box']['xmax'])
-                    roi = img[y2:y1, x1:x2]
-                    #cv2.imwrite('./roi.jpg', roi)
-                    if roi.size == 0:
-                        # Bad object roi...move on to next image.
-                        logging.error('Bad object roi.')
-                        label['face'] = None
-                        continue
-
-                    # Detect the (x, y)-coordinates of the bounding boxes corresponding
-                    # to each face in the input image.
-                    rgb = cv2.cvtColor(roi, cv2.COLOR_BGR2RGB)
-                    #cv2.imwrite('./rgb.jpg', rgb)
-                    detection = face_recognition.face_locations(rgb, NUMBER_OF_TIMES_TO_UPSAMPLE,
-                        FACE_DET_MODEL)
-                    if not detection:
-                        # No face detected...move on to next image.
-                        logging.debug('No face detected.')
-                        label['face'] = None
-                        continue
-
-                    # Carve out face roi and check to see if large enough for recognition.
-                    face_top, face_right, face_bottom, face_left = detection[0]
-                    #cv2.rectangle(rgb, (face_left, face_top), (face_right, face_bottom), (255,0,0), 2)
-                    #cv2.imwrite('./face_rgb.jpg', rgb)
-                    face_roi = roi[face_top:face_bottom, face_left:face_right]
-                    #cv2.imwrite('./face_roi.jpg', face_roi)
-                    (f_h, f_w) = face_roi.shape[:2]
-                    # If face width or height are not sufficiently large then skip.
-                    if f_h < MIN_FACE or f_w < MIN_FACE:
-                        logging.debug('Face too small to recognize.')
-                        label['face'] = None
-                        continue
-
-                    # Compute the focus measure of the face
-                    # using the Variance of Laplacian method.
-                    # See https://www.pyimagesearch.com/2015/09/07/blur-detection-with-opencv/
-                    gray = cv2.cvtColor(face_roi, cv2.COLOR_BGR2GRAY)
-                    fm = variance_of_laplacian(gray)
-                    # If fm below a threshold then face probably isn't clear enough
-                    # for face recognition to work, so skip it. 
-                    if fm < FOCUS_MEASURE_THRESHOLD:
-                        logging.debug('Face too blurry to recognize.')
-                        label['face'] = None
-                        continue
-
-                    # Find the 128-dimension face encoding for face in image.
-                    # face_locations in css order (top, right, bottom, left)
-                    face_location = (face_top, face_right, face_bottom, face_left)
-                    encoding = face_recognition.face_encodings(rgb,
-                        known_face_locations=[face_location], num_jitters=NUM_JITTERS)[0]
-                    logging.debug('face encoding {}'.format(encoding))
-                    # Perform classification on the encodings to recognize the face.
-                    (name, proba) = face_classifier(encoding, MIN_PROBA)
-
-                    # Add face name to label metadata.
-                    label['face'] = name
-                    # Add face confidence to label metadata.
-                    # (First convert NumPy value to native Python type for json serialization.)
-                    label['faceProba'] = proba.item()
-
-	        # Add processed image to output list. 
+            logger.debug('**********Find Face(s) for %s', obj['image'])
+            # Add image to output list, its person labels are updated in place. 
             objects_detected_faces.append(obj)
 
+            # If the objects detected are persons then try to identify them. 
+            person_labels = [label for label in obj['labels'] if label['name'] == 'person']
+            if not person_labels:
+                continue
+
+            # Get image read from disk once for all persons in it. 
+            img = image_reads[obj['image']].result()
+            if img is None:
+                # Bad image was read.
+                logger.error('Bad image was read.')
+                for label in person_labels:
+                    label['face'] = None
+                continue
+
+            image_persons = []
+            for label in person_labels:
+                # First bound the roi using the coord info passed in.
+                # The roi is area around person(s) detected in image.
+                # (x1, y1) are the top left roi coordinates.
+                # (x2, y2) are the bottom right roi coordinates.
+                y2 = int(label['box']['ymin'])
+                x1 = int(label['box']['xmin'])
+                y1 = int(label['box']['ymax'])
+                x2 = int(label['box']['xmax'])
+                roi = img[y2:y1, x1:x2]
+                #cv2.imwrite('./roi.jpg', roi)
+                if roi.size == 0:
+                    # Bad object roi...move on to next image.
+                    logger.error('Bad object roi.')
+                    label['face'] = None
+                    continue
+                image_persons.append((label, roi, (y2, y1, x1, x2)))
+
+            # Convert to dlib ordering (RGB). If the rois together cover more
+            # pixels than the image (e.g. several overlapping persons) then
+            # convert the whole image once and copy the rois out of it.
+            if sum(roi.size for (_, roi, _) in image_persons) > img.size:
+                rgb_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            else:
+                rgb_img = None
+            for (label, roi, (y2, y1, x1, x2)) in image_persons:
+                if rgb_img is None:
+                    rgb = cv2.cvtColor(roi, cv2.COLOR_BGR2RGB)
+                else:
+                    # dlib needs contiguous images.
+                    rgb = np.ascontiguousarray(rgb_img[y2:y1, x1:x2])
+                #cv2.imwrite('./rgb.jpg', rgb)
+                persons.append((label, roi, rgb))
+
+        # Detect the (x, y)-coordinates of the bounding boxes corresponding
+        # to each face in all the person rois at once.
+        detections = face_locations([rgb for (_, _, rgb) in persons])
+        # Faces to recognize with the person rois they are in.
+        faces = []
+
+        for ((label, roi, rgb), detection) in zip(persons, detections):
+            if not detection:
+                # No face detected...move on to next roi.
+                logger.debug('No face detected.')
+                label['face'] = None
+                continue
+
+            # Carve out face roi and check to see if large enough for recognition.
+            face_top, face_right, face_bottom, face_left = detection[0]
+            #cv2.rectangle(rgb, (face_left, face_top), (face_right, face_bottom), (255,0,0), 2)
+            #cv2.imwrite('./face_rgb.jpg', rgb)
+            face_roi = roi[face_top:face_bottom, face_left:face_right]
+            #cv2.imwrite('./face_roi.jpg', face_roi)
+            (f_h, f_w) = face_roi.shape[:2]
+            # If face width or height are not sufficiently large then skip.
+            if f_h < MIN_FACE or f_w < MIN_FACE:
+                logger.debug('Face too small to recognize.')
+                label['face'] = None
+                continue
+
+            # Compute the focus measure of the face
+            # using the Variance of Laplacian method.
+            # See https://www.pyimagesearch.com/2015/09/07/blur-detection-with-opencv/
+            gray = cv2.cvtColor(face_roi, cv2.COLOR_BGR2GRAY)
+            fm = variance_of_laplacian(gray)
+            # If fm below a threshold then face probably isn't clear enough
+            # for face recognition to work, so skip it. 
+            if fm < FOCUS_MEASURE_THRESHOLD:
+                logger.debug('Face too blurry to recognize.')
+                label['face'] = None
+                continue
+
+            # face_locations in css order (top, right, bottom, left)
+            face_location = (face_top, face_right, face_bottom, face_left)
+            faces.append((label, rgb, face_location))
+
+        # Find the 128-dimension face encodings for all faces at once.
+        encodings = face_encodings([(rgb, face_location)
+            for (_, rgb, face_location) in faces])
+
+        for ((label, _, _), encoding) in zip(faces, encodings):
+            logger.debug('face encoding %s', encoding)
+            # Perform classification on the encodings to recognize the face.
+            (name, proba) = face_classifier(encoding, MIN_PROBA)
+
+            # Add face name to label metadata.
+            label['face'] = name
+            # Add face confidence to label metadata.
+            # (First convert NumPy value to native Python type for json serialization.)
+            label['faceProba'] = proba.item()
+
         # Convert json to string and return data. 
         return(json.dumps(objects_detected_faces))
 
-s = zerorpc.Server(DetectRPC(), heartbeat=ZRPC_HEARTBEAT)
+# Create zerorpc object. 
+zerorpc_obj = DetectRPC()
+# Create and bind zerorpc server. 
+s = zerorpc.Server(zerorpc_obj, heartbeat=ZRPC_HEARTBEAT)
 s.bind(ZRPC_PIPE)
 # Register graceful ways to stop server. 
 gevent.signal(signal.SIGINT, s.stop) # Ctrl-C
 gevent.signal(signal.SIGTERM, s.stop) # termination
 # Start server.
 # This will block until a gevent signal is caught
-s.run()
\ No newline at end of file
+s.run()
+# After server is stopped then close it. 
+zerorpc_obj.close_server()
\ No newline at end of file
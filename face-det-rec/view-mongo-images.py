@@ -12,6 +12,7 @@ import pickle
 import cv2
 import json
 import numpy as np
+from numba import njit
 from shutil import copy
 from pymongo import MongoClient
 from bson import json_util
@@ -32,6 +33,8 @@ ap.add_argument('-io', '--image_decending_order', type=bool, default=False,
     help='set to True to see most recent alarms first')
 ap.add_argument('-up', '--upsample', type=int, default=1,
     help='number of times to upsample image to detect face')
+ap.add_argument('-mf', '--min_face', type=int, default=20,
+    help='minimum face width and height in pixels for recognition')
 args = vars(ap.parse_args())
 
 # Set to True if using SVM face classifier else knn will be used.
@@ -44,9 +47,9 @@ SVM_LABEL_PATH = '/home/lindo/develop/smart-zoneminder/face-det-rec/face_labels.
 MIN_SVM_PROBA = args['min_svm_proba']
 
 # Settings for knn face classifier.
-# Known face encodings.
-# The pickle file needs to be generated by the 'encode_faces.py' program first.
-KNOWN_FACE_ENCODINGS_PATH = '/home/lindo/develop/smart-zoneminder/face-det-rec/encodings.pickle' 
+# Known face encodings as a float32 matrix plus name ids.
+# The npz file needs to be generated by the 'encode_faces.py' program first.
+KNOWN_FACE_GALLERY_PATH = '/home/lindo/develop/smart-zoneminder/face-det-rec/gallery.npz' 
 # Face comparision tolerance. Only used for knn face classifier. 
 # A lower value causes stricter compares which may reduce false positives.
 # See https://github.com/ageitgey/face_recognition/wiki/Face-Recognition-Accuracy-Problems.
@@ -78,6 +81,10 @@ IMAGE_MIN_CONFIDENCE = 60
 # Images with Variance of Laplacian less than this are declared blurry. 
 FOCUS_MEASURE_THRESHOLD = args['focus_measure_threshold']
 
+# Faces with width or height less than this are too small for recognition.
+# In pixels.
+MIN_FACE = args['min_face']
+
 # Set to True to see most recent alarms first.
 IMAGE_DECENDING_ORDER = args['image_decending_order']
 
@@ -103,7 +110,10 @@ PVOC_XML_BASE_PATH = '/home/lindo/develop/tensorflow/models/annotations/xmls/'
 def variance_of_laplacian(image):
     # compute the Laplacian of the image and then return the focus
     # measure, which is simply the variance of the Laplacian
-    return cv2.Laplacian(image, cv2.CV_64F).var()
+    # the 8-bit image's Laplacian fits exactly in 16-bit ints so there
+    # is no need for a 64-bit float image to get the same variance
+    (_, stddev) = cv2.meanStdDev(cv2.Laplacian(image, cv2.CV_16S))
+    return stddev[0, 0] ** 2
 
 def generate_xml(image_path, image_shape, orig_h, orig_w, image_labels):
     # generate xml from the alarm image metadata
@@ -142,46 +152,45 @@ def generate_xml(image_path, image_shape, orig_h, orig_w, image_labels):
 
     return xml
 
+@njit(cache=True)
+def pick_name(counts, name_count, name_threshold):
+    # Return the id of the face name with the max count, or -1 if it's not valid.
+    # Compare each recognized face against the max face name.
+    # The max face name count must be greater than a certain value for
+    # it to be valid. This value is set at a percentage of the number of
+    # embeddings for that face name. 
+    max_id = 0
+    for i in range(1, counts.shape[0]):
+        if counts[i] > counts[max_id]:
+            max_id = i
+    limit = counts[max_id] - name_threshold * name_count[max_id]
+    for i in range(counts.shape[0]):
+        if i != max_id and counts[i] >= limit:
+            return -1
+    return max_id
+
 def knn_face_classifier(encoding, compare_face_tolerance, name_threshold, name_count):
     # attempt to match each face in the input image to our known encodings
-    matches = face_recognition.compare_faces(data['encodings'],
-        encoding, compare_face_tolerance)
+    # using squared L2 distances computed over the whole gallery in one pass
+    q = encoding.astype(np.float32)
+    d2 = enc_norm_sq + np.dot(q, q) - 2.0 * enc_mat.dot(q)
+    matches = d2 <= compare_face_tolerance * compare_face_tolerance
 
     # Assume face is unknown to start with. 
     name = 'Unknown'
 
     # check to see if we have found a match
-    if True in matches:
-        # find the indexes of all matched faces then initialize a
-        # dictionary to count the total number of times each face
-        # was matched
-        matchedIdxs = [i for (i, b) in enumerate(matches) if b]
-
-        # init all name counts to 0
-        counts = {n: 0 for n in data['names']}
-        #print('initial counts {}'.format(counts))
-
-        # loop over the matched indexes and maintain a count for
-        # each recognized face
-        for i in matchedIdxs:
-            name = data['names'][i]
-            counts[name] = counts.get(name, 0) + 1
+    if matches.any():
+        # count the total number of times each face name was matched
+        counts = np.bincount(name_ids[matches], minlength=len(id_to_name))
         #print('counts {}'.format(counts))
 
-        # Find face name with the max count value.
-        max_value = max(counts.values())
-        max_name = max(counts, key=counts.get)
-
-        # Compare each recognized face against the max face name.
-        # The max face name count must be greater than a certain value for
-        # it to be valid. This value is set at a percentage of the number of
-        # embeddings for that face name. 
-        name_thresholds = [max_value > value + name_threshold * name_count[max_name]
-            for name, value in counts.items() if name != max_name]
+        # Find face name with the max count value and check it is valid.
+        max_id = pick_name(counts, name_count, name_threshold)
 
         # If max face name passes against all other faces then declare it valid.
-        if all(name_thresholds):
-            name = max_name
+        if max_id >= 0:
+            name = id_to_name[max_id]
             print('kkn says this is {}'.format(name))
         else:
             name = None
@@ -247,12 +256,15 @@ if USE_SVM_CLASS is True:
         le = pickle.load(fp)
 else:
     # Load the known faces and embeddings.
-    with open(KNOWN_FACE_ENCODINGS_PATH, 'rb') as fp:
-        data = pickle.load(fp)
+    # Encodings are stored as a contiguous (N, 128) float32 matrix
+    # with an integer face name id per encoding.
+    with np.load(KNOWN_FACE_GALLERY_PATH) as gallery:
+        enc_mat = np.ascontiguousarray(gallery['enc'], dtype=np.float32)
+        name_ids = gallery['ids']
+        id_to_name = gallery['names'].tolist()
+    enc_norm_sq = (enc_mat * enc_mat).sum(axis=1)
     # Calculate number of embeddings for each face name.
-    name_count = {n: 0 for n in data['names']}
-    for name in data['names']:
-        name_count[name] += 1
+    name_count = np.bincount(name_ids, minlength=len(id_to_name))
     #print(name_count)
 
 client = MongoClient(MONGO_URL)
@@ -338,36 +350,43 @@ while True:
                 face_roi = roi[face_top:face_bottom, face_left:face_right, :]
                 #cv2.imshow('face roi', face_roi)
                 #cv2.waitKey(0)
+                (f_h, f_w) = face_roi.shape[:2]
 
-                # Compute the focus measure of the face
-                # using the Variance of Laplacian method.
-                # See https://www.pyimagesearch.com/2015/09/07/blur-detection-with-opencv/
-                gray = cv2.cvtColor(face_roi, cv2.COLOR_BGR2GRAY)
-                fm = variance_of_laplacian(gray)
-                print('fm {}'.format(fm))
-
-                if fm < FOCUS_MEASURE_THRESHOLD:
-                    # If fm below a threshold then face probably isn't clear enough
-                    # for face recognition to work, so just skip it. 
-                    print('face is blurred...skipping face rec')
+                if f_h < MIN_FACE or f_w < MIN_FACE:
+                    # If face is too small then recognition won't work so
+                    # skip it before paying for the focus measure and encoding.
+                    print('face is too small...skipping face rec')
                     names = [None]
                 else:
-                    # Return the 128-dimension face encoding for face in the image.
-                    # TODO - figure out why encodings are slightly different in
-                    # face_det_rec.py for same image
-                    encoding = face_recognition.face_encodings(rgb, box, NUM_JITTERS)[0]
-
-                    if USE_SVM_CLASS is True:
-                        # perform svm classification to recognize the face
-                        name = svm_face_classifier(encoding, MIN_SVM_PROBA)
+                    # Compute the focus measure of the face
+                    # using the Variance of Laplacian method.
+                    # See https://www.pyimagesearch.com/2015/09/07/blur-detection-with-opencv/
+                    gray = cv2.cvtColor(face_roi, cv2.COLOR_BGR2GRAY)
+                    fm = variance_of_laplacian(gray)
+                    print('fm {}'.format(fm))
+
+                    if fm < FOCUS_MEASURE_THRESHOLD:
+                        # If fm below a threshold then face probably isn't clear enough
+                        # for face recognition to work, so just skip it. 
+                        print('face is blurred...skipping face rec')
+                        names = [None]
                     else:
-                        # perform knn classification to recognize the face
-                        name = knn_face_classifier(encoding, COMPARE_FACES_TOLERANCE,
-                            NAME_THRESHOLD, name_count)
-
-                    print('name {}'.format(name))
-                    # update the list of names
-                    names.append(name)
+                        # Return the 128-dimension face encoding for face in the image.
+                        # TODO - figure out why encodings are slightly different in
+                        # face_det_rec.py for same image
+                        encoding = face_recognition.face_encodings(rgb, box, NUM_JITTERS)[0]
+
+                        if USE_SVM_CLASS is True:
+                            # perform svm classification to recognize the face
+                            name = svm_face_classifier(encoding, MIN_SVM_PROBA)
+                        else:
+                            # perform knn classification to recognize the face
+                            name = knn_face_classifier(encoding, COMPARE_FACES_TOLERANCE,
+                                NAME_THRESHOLD, name_count)
+
+                        print('name {}'.format(name))
+                        # update the list of names
+                        names.append(name)
             
             # Draw the object roi and its label on the image.
             # This must be done after fm calc otherwise drawing edge will affect result. 
@@ -18,6 +18,7 @@ import zerorpc
 import logging
 import gevent
 import signal
+from concurrent.futures import ThreadPoolExecutor
 
 logging.basicConfig(
     format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
@@ -30,6 +31,7 @@ with open('./config.json') as fp:
     config = json.load(fp)['personClassifierServer']
 
 # Path to TensorFlow Saved Model.
+# This can also be a TF-TRT model generated by 'saved_model_to_trt.py'.
 PATH_TO_MODEL = config['savedModel']
 
 # Model input size.
@@ -38,6 +40,24 @@ MODEL_INPUT_SIZE = tuple(config['modelInputSize'])
 # Model preprocessor function.
 PREPROCESSOR = eval(config['preprocessor'])
 
+# Set to True to crop, resize and preprocess person rois on the GPU.
+# The preprocessed batch then stays on the GPU for inference.
+GPU_PREPROCESS = config['gpuPreprocess']
+
+# Number of threads used to read and decode alarm images.
+READER_THREADS = config['readerThreads']
+
+# Initial number of person rois the preprocessing buffers hold.
+# The buffers grow if a request has more.
+ROI_BUFFER_SIZE = config['roiBufferSize']
+
+# Set to True to enable XLA JIT compilation of the model.
+# This fuses ops such as conv + bias + relu into single kernels.
+# XLA compiles the model again for every new batch size, which can take
+# seconds, so batch sizes up to ROI_BUFFER_SIZE are compiled at server start.
+# Larger batches still compile on a live request. Off by default.
+XLA_JIT = config['xlaJit']
+
 # Minimum score for valid TF person detection. 
 MIN_PROBA = config['minProba']
 
@@ -64,6 +84,9 @@ if gpus:
         # Memory growth must be set before GPUs have been initialized
         logger.debug(e)
 
+# Enable XLA auto-clustering, must be set before the model is loaded.
+tf.config.optimizer.set_jit(XLA_JIT)
+
 # Load model and prepare for inference.
 # See: https://www.tensorflow.org/guide/saved_model
 loaded = tf.saved_model.load(PATH_TO_MODEL)
@@ -71,83 +94,223 @@ infer = loaded.signatures['serving_default']
 logger.debug('Model output info {}:'.format(infer.structured_outputs))
 output = list(infer.structured_outputs.keys())[0]
 
+# ImageNet channel means in BGR order used by 'caffe' style preprocessing.
+IMAGENET_MEAN_BGR = np.array([103.939, 116.779, 123.68], dtype=np.float32)
+
+def preprocess_tf(src, dst):
+    # Same as keras 'tf' style preprocess_input.
+    # Scale uint8 pixels in src to [-1, 1] and store them in float dst.
+    np.multiply(src, np.float32(1.0 / 127.5), out=dst)
+    dst -= np.float32(1.0)
+
+def preprocess_caffe(src, dst):
+    # Same as keras 'caffe' style preprocess_input.
+    # Flip channel order of uint8 pixels in src, zero-center each channel
+    # with respect to ImageNet and store them in float dst.
+    np.subtract(src[..., ::-1], IMAGENET_MEAN_BGR, out=dst)
+
+# Inline versions of the keras preprocessors that write directly into
+# the roi buffer without temporary arrays.
+INLINE_PREPROCESSORS = {
+    'tf.keras.applications.inception_resnet_v2.preprocess_input': preprocess_tf,
+    'tf.keras.applications.mobilenet_v2.preprocess_input': preprocess_tf,
+    'tf.keras.applications.nasnet.preprocess_input': preprocess_tf,
+    'tf.keras.applications.resnet50.preprocess_input': preprocess_caffe,
+    'tf.keras.applications.vgg16.preprocess_input': preprocess_caffe
+}
+INLINE_PREPROCESSOR = INLINE_PREPROCESSORS.get(config['preprocessor'])
+
+def preprocess(src, dst):
+    # Preprocess uint8 rois in src into float dst for the model.
+    # Fall back to the configured keras preprocessor if there is no inline one.
+    if INLINE_PREPROCESSOR is None:
+        np.copyto(dst, src)
+        return PREPROCESSOR(dst)
+    INLINE_PREPROCESSOR(src, dst)
+    return dst
+
+def gpu_preprocess(image_path, labels):
+    # Crop, resize and preprocess all person rois of an image with TensorFlow
+    # ops so that this runs on the GPU alongside the classifier.
+    # Returns the batch of rois as a tensor and the labels they belong to.
+    try:
+        img = tf.io.decode_image(tf.io.read_file(image_path),
+            channels=3, expand_animations=False)
+    except tf.errors.OpError:
+        return None, []
+    # Match channel order of images read by OpenCV.
+    img = tf.reverse(img, axis=[-1])
+    (h, w) = img.shape[:2]
+
+    boxes = []
+    roi_labels = []
+    for label in labels:
+        # Clip the roi to the image like slicing does, then normalize
+        # its coords as expected by crop_and_resize.
+        ymin = max(int(label['box']['ymin']), 0)
+        xmin = max(int(label['box']['xmin']), 0)
+        ymax = min(int(label['box']['ymax']), h)
+        xmax = min(int(label['box']['xmax']), w)
+        if ymax <= ymin or xmax <= xmin:
+            # Bad object roi...move on to next label.
+            logger.error('Bad object roi.')
+            label['face'] = None
+            continue
+        boxes.append([ymin / (h - 1), xmin / (w - 1),
+            (ymax - 1) / (h - 1), (xmax - 1) / (w - 1)])
+        roi_labels.append(label)
+
+    if not boxes:
+        return None, []
+
+    # Model input size is (width, height) while crop size is (height, width).
+    rois = tf.image.crop_and_resize(tf.expand_dims(tf.cast(img, tf.float32), 0),
+        boxes=boxes, box_indices=tf.zeros(len(boxes), dtype=tf.int32),
+        crop_size=MODEL_INPUT_SIZE[::-1])
+    return PREPROCESSOR(rois), roi_labels
+
 # zerorpc class.
 class DetectRPC(object):
     def __init__(self):
         logger.debug('Starting server for person classification.')
-        # add optional init statements
+        # Thread pool that reads alarm images.
+        self.executor = ThreadPoolExecutor(max_workers=READER_THREADS)
+        # Preallocated buffers for resized (uint8) and preprocessed (float32)
+        # person rois, grown as needed and reused across requests.
+        # Model input size is (width, height) so reverse it for array shape.
+        roi_shape = (ROI_BUFFER_SIZE,) + MODEL_INPUT_SIZE[::-1] + (3,)
+        self.rois_u8 = np.empty(roi_shape, dtype=np.uint8)
+        self.rois_f32 = np.empty(roi_shape, dtype=np.float32)
+        # Compile the XLA clusters for every batch size the roi buffers
+        # hold so that it doesn't happen on a live request.
+        if XLA_JIT:
+            for num_rois in range(1, ROI_BUFFER_SIZE + 1):
+                logger.debug('XLA warm up with batch size %s', num_rois)
+                infer(tf.constant(self.rois_f32[:num_rois]))
+
+    def _reserve_rois(self, num_rois):
+        # Grow the roi buffers to hold at least num_rois,
+        # keeping the resized rois already stored.
+        if num_rois > len(self.rois_u8):
+            size = max(num_rois, 2 * len(self.rois_u8))
+            rois_u8 = np.empty((size,) + self.rois_u8.shape[1:], dtype=np.uint8)
+            rois_u8[:len(self.rois_u8)] = self.rois_u8
+            self.rois_u8 = rois_u8
+            self.rois_f32 = np.empty(rois_u8.shape, dtype=np.float32)
 
     def close_server(self):
         logger.debug('Closing server for person classification.')
-        # add optional close statements
+        self.executor.shutdown()
 
     def detect_faces(self, test_image_paths):
         # List that will hold all images with any person classifications. 
         objects_classified_persons = []
+        # Labels of the person rois to classify and, if preprocessed on the
+        # GPU, their rois. Otherwise the rois are held in the roi buffers.
+        rois = []
+        roi_labels = []
+        # Start reading images with persons on the thread pool so decoding
+        # overlaps with processing the images already read.
+        # OpenCV releases the GIL while decoding.
+        image_reads = {obj['image']: self.executor.submit(cv2.imread, obj['image'])
+            for obj in test_image_paths
+            if not GPU_PREPROCESS
+            and any(label['name'] == 'person' for label in obj['labels'])}
         for obj in test_image_paths:
-            logger.debug('**********Classify person for {}'.format(obj['image']))
-            for label in obj['labels']:
-                # If the object detected is a person then try to identify face. 
-                if label['name'] == 'person':
-                    # Read image from disk. 
-                    img = cv2.imread(obj['image'])
-                    if img is None:
-                        # Bad image was read.
-                        logging.error('Bad image was read.')
-                        label['face'] = None
-                        continue
-
-                    # First bound the roi using the coord info passed in.
-                    # The roi is area around person(s) detected in image.
-                    # (x1, y1) are the top left roi coordinates.
-                    # (x2, y2) are the bottom right roi coordinates.
-                    y2 = int(label['box']['ymin'])
-                    x1 = int(label['box']['xmin'])
-                    y1 = int(label['box']['ymax'])
-                    x2 = int(label['box']['xmax'])
-                    roi = img[y2:y1, x1:x2]
-                    #cv2.imwrite('./roi.jpg', roi)
-                    if roi.size == 0:
-                        # Bad object roi...move on to next image.
-                        logger.error('Bad object roi.')
-                        label['face'] = None
-                        continue
-
-                    # Format image to what the model expects for input.
-                    # Resize.
-                    roi = cv2.resize(roi, dsize=MODEL_INPUT_SIZE,
-                        interpolation=cv2.INTER_AREA)
-                    # Expand dimensions.
-                    roi = np.expand_dims(roi, axis=0)
-                    # Preprocess.
-                    roi = PREPROCESSOR(roi.astype('float32'))
-
-                    # Actual predictions per class.
-                    predictions = infer(tf.constant(roi))[output]
-
-                    # Find most likely prediction.
-                    proba = np.amax(predictions)
-                    j = np.argmax(predictions)
-                    person = LABEL_MAP[j]
-                    logger.debug('person classifier proba {} name {}'
-                        .format(proba, person))
-                    if proba >= MIN_PROBA:
-                        name = person
-                        logger.debug('person classifier says this is {}'
-                            .format(name))
-                    else:
-                        name = None # prob too low to recog face
-                        logger.debug('person classifier cannot recognize person')
-
-                    # Add face name to label metadata.
-                    label['face'] = name
-                    # Add face confidence to label metadata.
-                    # (First convert NumPy value to native Python type for json serialization.)
-                    label['faceProba'] = proba.item()
-
-                    # Add processed image to output list. 
+            logger.debug('**********Classify person for %s', obj['image'])
+            # Add image to output list, its person labels are updated in place. 
             objects_classified_persons.append(obj)
 
+            # If the objects detected are persons then try to identify them. 
+            person_labels = [label for label in obj['labels'] if label['name'] == 'person']
+            if not person_labels:
+                continue
+
+            if GPU_PREPROCESS:
+                (roi, valid_labels) = gpu_preprocess(obj['image'], person_labels)
+                if roi is None:
+                    logger.error('Bad image or no valid rois.')
+                    for label in person_labels:
+                        label['face'] = None
+                    continue
+                rois.append(roi)
+                roi_labels.extend(valid_labels)
+                continue
+
+            # Get image read from disk once for all persons in it. 
+            img = image_reads[obj['image']].result()
+            if img is None:
+                # Bad image was read.
+                logger.error('Bad image was read.')
+                for label in person_labels:
+                    label['face'] = None
+                continue
+
+            for label in person_labels:
+                # First bound the roi using the coord info passed in.
+                # The roi is area around person(s) detected in image.
+                # (x1, y1) are the top left roi coordinates.
+                # (x2, y2) are the bottom right roi coordinates.
+                y2 = int(label['box']['ymin'])
+                x1 = int(label['box']['xmin'])
+                y1 = int(label['box']['ymax'])
+                x2 = int(label['box']['xmax'])
+                roi = img[y2:y1, x1:x2]
+                #cv2.imwrite('./roi.jpg', roi)
+                if roi.size == 0:
+                    # Bad object roi...move on to next image.
+                    logger.error('Bad object roi.')
+                    label['face'] = None
+                    continue
+
+                # Format image to what the model expects for input.
+                # Resize into the next free slot of the roi buffer.
+                # INTER_AREA is only better when shrinking, use INTER_LINEAR otherwise.
+                (h, w) = roi.shape[:2]
+                if w > MODEL_INPUT_SIZE[0] and h > MODEL_INPUT_SIZE[1]:
+                    interpolation = cv2.INTER_AREA
+                else:
+                    interpolation = cv2.INTER_LINEAR
+                i = len(roi_labels)
+                self._reserve_rois(i + 1)
+                cv2.resize(roi, dsize=MODEL_INPUT_SIZE, dst=self.rois_u8[i],
+                    interpolation=interpolation)
+
+                roi_labels.append(label)
+
+        if roi_labels:
+            # Actual predictions per class for all person rois in one batch.
+            if GPU_PREPROCESS:
+                batch = tf.concat(rois, axis=0)
+            else:
+                # Convert and preprocess all rois at once into the float buffer.
+                num_rois = len(roi_labels)
+                batch = tf.constant(preprocess(self.rois_u8[:num_rois],
+                    self.rois_f32[:num_rois]))
+            predictions = infer(batch)[output]
+            predictions = predictions.numpy()
+
+            # Find most likely prediction for each roi.
+            probas = np.amax(predictions, axis=1)
+            indices = np.argmax(predictions, axis=1)
+            for (label, proba, j) in zip(roi_labels, probas, indices):
+                person = LABEL_MAP[j]
+                logger.debug('person classifier proba %s name %s',
+                    proba, person)
+                if proba >= MIN_PROBA:
+                    name = person
+                    logger.debug('person classifier says this is %s',
+                        name)
+                else:
+                    name = None # prob too low to recog face
+                    logger.debug('person classifier cannot recognize person')
+
+                # Add face name to label metadata.
+                label['face'] = name
+                # Add face confidence to label metadata.
+                # (First convert NumPy value to native Python type for json serialization.)
+                label['faceProba'] = proba.item()
+
         # Convert json to string and return data. 
         return(json.dumps(objects_classified_persons))
 
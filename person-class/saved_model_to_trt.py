@@ -0,0 +1,127 @@
+"""
+Convert a TensorFlow saved model to a TF-TRT optimized saved model for inference.
+
+The converted model replaces supported subgraphs with TensorRT engines
+(layer fusion and reduced precision on Tensor Cores) and is loaded by
+person_classifier_server.py exactly like the original saved model.
+
+INT8 engines are calibrated on images from the training dataset that are
+preprocessed the same way as in person_classifier_server.py.
+
+This is part of the smart-zoneminder project.
+See https://github.com/goruck/smart-zoneminder
+
+Ref:
+https://docs.nvidia.com/deeplearning/frameworks/tf-trt-user-guide/index.html
+
+Copyright (c) 2020 Lindo St. Angel
+"""
+
+import tensorflow as tf
+import numpy as np
+import argparse
+import logging
+import json
+from functools import partial
+from tensorflow.python.compiler.tensorrt import trt_convert as trt
+from keras_to_tflite_quant import representative_dataset_gen
+
+logger = logging.getLogger(__name__)
+
+# Use same config as person_classifier_server.py.
+with open('./config.json') as fp:
+    config = json.load(fp)
+
+PREPROCESSOR = eval(config['personClassifierServer']['preprocessor'])
+
+def get_input_size(saved_model_dir):
+    # Get model input height and width from the serving signature.
+    loaded = tf.saved_model.load(saved_model_dir)
+    infer = loaded.signatures['serving_default']
+    input_spec = list(infer.structured_input_signature[1].values())[0]
+    return tuple(input_spec.shape[1:3])
+
+def build_input_fn(input_size, max_batch_size):
+    # Feed a single dummy input of the maximum batch size so the TensorRT
+    # engines are built ahead of time instead of on first use.
+    # In implicit batch mode that engine also serves every smaller batch.
+    def input_fn():
+        yield [np.zeros((max_batch_size,) + input_size + (3,), dtype=np.float32)]
+    return input_fn
+
+def convert(saved_model_dir, output_dir, precision_mode, max_batch_size,
+    cal_dataset, num_cal):
+    logger.info('Starting conversion of saved model to TF-TRT model.')
+
+    input_size = get_input_size(saved_model_dir)
+    logger.info('input size: {}'.format(input_size))
+
+    use_calibration = precision_mode == 'INT8'
+    conversion_params = trt.DEFAULT_TRT_CONVERSION_PARAMS._replace(
+        precision_mode=precision_mode,
+        max_batch_size=max_batch_size,
+        max_workspace_size_bytes=1 << 30,
+        use_calibration=use_calibration)
+
+    converter = trt.TrtGraphConverterV2(
+        input_saved_model_dir=saved_model_dir,
+        conversion_params=conversion_params)
+
+    if use_calibration:
+        logger.info('Calibrating with {} images from {}'.format(num_cal, cal_dataset))
+        # calibration_input_fn must be a callable so use partial to set parameters. 
+        cal_gen = partial(representative_dataset_gen,
+            path=cal_dataset,
+            num_cal=num_cal,
+            input_size=input_size,
+            preprocessor=PREPROCESSOR)
+        converter.convert(calibration_input_fn=cal_gen)
+    else:
+        converter.convert()
+    converter.build(input_fn=build_input_fn(input_size, max_batch_size))
+
+    converter.save(output_dir)
+
+    logger.info('TF-TRT model saved to {}'.format(output_dir))
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--input',
+        type=str,
+        required=True,
+        help='saved model directory to convert')
+    ap.add_argument('--output',
+        type=str,
+        required=True,
+        help='directory of converted output model')
+    ap.add_argument('--precision',
+        type=str,
+        choices=['FP32', 'FP16', 'INT8'],
+        default='FP16',
+        help='precision of the TensorRT engines')
+    ap.add_argument('--max_batch_size',
+        type=int,
+        default=8,
+        help='largest batch of person rois the engines are built for, '
+            'should cover the most persons expected in a request')
+    ap.add_argument('--dataset',
+        default='/home/lindo/develop/smart-zoneminder/face-det-rec/dataset',
+        help='location of input dataset used for INT8 calibration')
+    ap.add_argument('--num_cal',
+        type=int,
+        default=200,
+        help='number of images to use for INT8 calibration')
+    args = vars(ap.parse_args())
+
+    logging.basicConfig(format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+        level=logging.DEBUG)
+
+    convert(args['input'],
+        args['output'],
+        args['precision'],
+        args['max_batch_size'],
+        args['dataset'] + '/Unknown/', # Use Unknown images for calibration
+        args['num_cal'])
+
+if __name__ == '__main__':
+    main()
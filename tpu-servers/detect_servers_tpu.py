@@ -316,7 +316,9 @@ class FaceDetectRPC(object):
                     # using the Variance of Laplacian method.
                     # See https://www.pyimagesearch.com/2015/09/07/blur-detection-with-opencv/
                     gray = cv2.cvtColor(face_roi, cv2.COLOR_BGR2GRAY)
-                    fm = cv2.Laplacian(gray, cv2.CV_64F).var()
+                    # The 8-bit image's Laplacian fits exactly in 16-bit ints.
+                    (_, stddev) = cv2.meanStdDev(cv2.Laplacian(gray, cv2.CV_16S))
+                    fm = stddev[0, 0] ** 2
                     # If fm below a threshold then face probably isn't clear enough
                     # for face recognition to work, so skip it. 
                     if fm < FACE_FOCUS_MEASURE_THRESHOLD:
@@ -118,6 +118,52 @@ const FTYPE = 'Alarm';
 const logger = require('./logger');
 console.log('Logger created...');
 
+// Persistent zerorpc clients keyed by pipe.
+// Reusing a connection avoids setting up a new socket for every detection request.
+const zerorpcClients = {};
+
+// Reject callbacks of in-flight requests keyed by client.
+// A client level error fails these so callers don't wait forever.
+const zerorpcPending = new Map();
+
+/**
+ * Returns a connected zerorpc client for the given pipe, creating it if needed.
+ * 
+ * @param {string} pipe - IPC (or TCP) socket of the zerorpc server.
+ */
+const getZerorpcClient = pipe => {
+    if (!(pipe in zerorpcClients)) {
+        const zerorpcClient = new zerorpc.Client({heartbeatInterval: ZERORPC_HEARTBEAT});
+        zerorpcClient.connect(pipe);
+        zerorpcClient.on('error', error => {
+            logger.error(`zerorpc client error on ${pipe}: ${error}`);
+            closeZerorpcClient(pipe, zerorpcClient, error);
+        });
+        zerorpcClients[pipe] = zerorpcClient;
+        zerorpcPending.set(zerorpcClient, new Set());
+    }
+    return zerorpcClients[pipe];
+};
+
+/**
+ * Closes and forgets a zerorpc client and rejects its in-flight requests.
+ * The client is only closed if it is still the one registered for the pipe
+ * so a late error from a replaced client can't close its successor.
+ * The next request on the pipe will reconnect.
+ * 
+ * @param {string} pipe - IPC (or TCP) socket of the zerorpc server.
+ * @param {object} zerorpcClient - Client to close.
+ * @param {Error} error - Reason passed to pending requests.
+ */
+const closeZerorpcClient = (pipe, zerorpcClient, error) => {
+    if (zerorpcClients[pipe] !== zerorpcClient) return;
+    delete zerorpcClients[pipe];
+    const pending = zerorpcPending.get(zerorpcClient);
+    zerorpcPending.delete(zerorpcClient);
+    zerorpcClient.close();
+    pending.forEach(reject => reject(error));
+};
+
 /**
  * Returns an array with string and int representations of the
  * difference between start and current process.hrtime().
@@ -464,18 +510,18 @@ const getFrames = () => {
                     pipe = OBJ_DET_ZERORPC_PIPE : pipe = FACE_DET_ZERORPC_PIPE;
 
                 // Heartbeat must be greater than the time required to run detection on maxInit frames.
-                // TODO - make heartbeat automatic to keep connection open, latency might be better. 
-                const zerorpcClient = new zerorpc.Client({heartbeatInterval: ZERORPC_HEARTBEAT});
-                zerorpcClient.connect(pipe);
+                // The connection is kept open between requests.
+                const zerorpcClient = getZerorpcClient(pipe);
 
-                return new Promise((resolve, reject) => {
-                    zerorpcClient.on('error', error => {
-                        reject(error);
-                    });
+                const pending = zerorpcPending.get(zerorpcClient);
 
+                return new Promise((resolve, reject) => {
+                    pending.add(reject);
                     zerorpcClient.invoke(detectionType, imagePaths, (error, data) => {
-                        zerorpcClient.close();
+                        pending.delete(reject);
                         if (error) {
+                            // Drop the connection so the next request reconnects.
+                            closeZerorpcClient(pipe, zerorpcClient, error);
                             reject(error);
                         } else {
                             const dur2 = parseHrtime(startTime)[1];